@@ -4,17 +4,31 @@ import gspread
 import pandas as pd
 import numpy as np
 import logging
+import logging.handlers
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
 
 # Configure logging
 log_filename = os.path.join(os.path.dirname(__file__), '../consolidacion.log')
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+file_handler = logging.FileHandler(log_filename)
+file_handler.setFormatter(log_formatter)
+# Buffer file writes instead of flushing per record; errors flush immediately
+# and logging.shutdown() drains the buffer at exit
+buffered_file_handler = logging.handlers.MemoryHandler(capacity=1000, target=file_handler)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler()
+        buffered_file_handler,
+        stream_handler
     ]
 )
 
@@ -35,21 +49,19 @@ def get_credentials():
         logging.info("Using credentials from local file.")
         credentials_path = os.path.join(os.path.dirname(__file__), '../credentials/credentials.json')
         if not os.path.exists(credentials_path):
-            logging.error(f"Credentials not found at {credentials_path}")
+            logging.error("Credentials not found at %s", credentials_path)
             raise FileNotFoundError(f"Credentials not found at {credentials_path} or in environment variables.")
         creds = Credentials.from_service_account_file(credentials_path, scopes=scopes)
     
     return creds
 
-def clean_currency(x):
-    if isinstance(x, str):
-        # Format: ' 139.15 € '
-        clean_str = x.replace('€', '').replace('$', '').replace(',', '').strip()
-        try:
-            return float(clean_str)
-        except ValueError:
-            return 0.0
-    return x
+def aggregate_invoices(pairs, group_keys):
+    grouped = pairs.groupby(group_keys, observed=True).agg(
+        Monto=('Total', 'sum'),
+        Numero_Facturas=('Num', 'size'),
+        Lista_Facturas=('Num', lambda s: s.astype(str).str.cat(sep=', '))
+    ).reset_index()
+    return grouped[grouped['Monto'] > 0]
 
 def main():
     try:
@@ -59,9 +71,17 @@ def main():
         pd.set_option('display.max_columns', None)
         pd.set_option('display.max_rows', 100)
 
-        # Authenticate
+        # Authenticate with one pooled session so every Sheets call reuses the
+        # TCP/TLS connection, with retries on quota/server errors
         creds = get_credentials()
-        client = gspread.authorize(creds)
+        session = AuthorizedSession(creds)
+        session.headers.update({'Accept-Encoding': 'gzip'})
+        session.mount('https://', HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        ))
+        client = gspread.authorize(creds, session=session)
 
         # Open spreadsheet
         spreadsheet_url = 'https://docs.google.com/spreadsheets/d/1f7ZRIRJ5_cbnK4ZQPTL2uAn91zQeUy6cbCqeBliXjtQ/edit'
@@ -70,35 +90,48 @@ def main():
         # Collect dataframes
         dfs = []
         logging.info("Processing worksheets...")
-        for worksheet in sh.worksheets():
-            title = worksheet.title
-            if title.isdigit() and len(title) == 4:
-                logging.info(f"Processing sheet: {title}")
-                rows = worksheet.get_all_values()
-                if rows:
-                    headers = rows[0]
-                    df = pd.DataFrame(rows[1:], columns=headers)
-                    df = df.loc[:, df.columns != '']
-                    df['Year_Source'] = title
-                    dfs.append(df)
+        year_titles = [ws.title for ws in sh.worksheets() if ws.title.isdigit() and len(ws.title) == 4]
+        value_ranges = []
+        if year_titles:
+            # One batchGet round trip for all year sheets instead of one request per sheet
+            response = sh.values_batch_get(ranges=[f"'{title}'" for title in year_titles])
+            value_ranges = response.get('valueRanges', [])
+        for title, value_range in zip(year_titles, value_ranges):
+            logging.info("Processing sheet: %s", title)
+            rows = value_range.get('values', [])
+            if rows:
+                # batchGet trims trailing empty cells, so pad rows to a common width
+                width = max(len(row) for row in rows)
+                headers = rows[0] + [''] * (width - len(rows[0]))
+                padded = [row + [''] * (width - len(row)) for row in rows[1:]]
+                df = pd.DataFrame(padded, columns=headers)
+                df = df.loc[:, df.columns != '']
+                df['Year_Source'] = title
+                dfs.append(df)
 
         if not dfs:
             logging.warning("No year-formatted sheets found.")
             return
 
         df_consolidado = pd.concat(dfs, ignore_index=True)
+        # Both columns have very few unique values; category codes make the
+        # downstream filters and groupbys integer compares instead of string compares
+        df_consolidado['Year_Source'] = df_consolidado['Year_Source'].astype('category')
+        df_consolidado['Cliente'] = df_consolidado['Cliente'].astype('category')
         logging.info("Consolidation complete.")
 
         # Data Cleaning
         logging.info("Cleaning data...")
         df_consolidado['Fecha'] = pd.to_datetime(df_consolidado['Fecha'], dayfirst=False, errors='coerce')
-        df_consolidado['Vencimiento'] = pd.to_datetime(df_consolidado['Vencimiento'], dayfirst=False, errors='coerce')
         df_consolidado['Fecha de cobro'] = pd.to_datetime(df_consolidado['Fecha de cobro'], dayfirst=False, errors='coerce')
 
-        if df_consolidado['Total'].dtype == 'object':
-            df_consolidado['Total'] = df_consolidado['Total'].apply(clean_currency)
-        else:
-            df_consolidado['Total'] = pd.to_numeric(df_consolidado['Total'], errors='coerce').fillna(0)
+        # Format: ' 139.15 € '
+        totals = df_consolidado['Total'].astype(str).str.replace(r'[€$,]', '', regex=True).str.strip()
+        df_consolidado['Total'] = pd.to_numeric(totals, errors='coerce').fillna(0.0)
+
+        # Only these columns feed the gold layer; dropping the rest shrinks
+        # every scan and copy from here on
+        df_consolidado = df_consolidado[['Fecha', 'Fecha de cobro', 'Cliente', 'Total', 'Num']].copy()
 
         # Generate Gold Layer
         logging.info("Generating Gold Layer...")
@@ -115,205 +148,88 @@ def main():
         current_date = max_date.replace(day=1)
         
         date_range = pd.date_range(start=start_date, end=current_date, freq='MS')
-        clients = df_consolidado['Cliente'].unique()
-        
-        gold_rows = []
-        
-        for snapshot_date in date_range:
-            is_current_month = (snapshot_date.year == now.year) and (snapshot_date.month == now.month)
-            
-            billing_in_month = df_consolidado[
-                (df_consolidado['Fecha'].dt.year == snapshot_date.year) & 
-                (df_consolidado['Fecha'].dt.month == snapshot_date.month)
-            ]
-            
-            relevant_invoices_debt = df_consolidado[df_consolidado['Fecha'] <= snapshot_date]
-            
-            for client in clients:
-                # Billing
-                client_billing_df = billing_in_month[billing_in_month['Cliente'] == client]
-                client_billing = client_billing_df['Total'].sum()
-                
-                if client_billing > 0:
-                    gold_rows.append({
-                        'Fecha_Reporte': snapshot_date,
-                        'Cliente': client,
-                        'Concepto': 'Facturación Mensual',
-                        'Monto': client_billing,
-                        'Es_Mes_Actual': is_current_month,
-                        'Numero_Facturas': len(client_billing_df),
-                        'Lista_Facturas': ', '.join(client_billing_df['Num'].astype(str).tolist())
-                    })
-                
-                # Debt
-                client_invoices = relevant_invoices_debt[relevant_invoices_debt['Cliente'] == client]
-                 
-                deuda_lt_3_sum = 0
-                deuda_3_6_sum = 0
-                deuda_6_12_sum = 0
-                deuda_gt_12_sum = 0
-                crossed_3_months_sum = 0
-                
-                paid_debt_post_start_sum = 0
-                paid_alert_post_start_sum = 0
-                
-                list_lt_3 = []
-                list_3_6 = []
-                list_6_12 = []
-                list_gt_12 = []
-                list_crossed = []
-                list_paid_post_start = []
-                list_paid_alert = []
-                
-                for _, invoice in client_invoices.iterrows():
-                    payment_date = invoice['Fecha de cobro']
-                    invoice_date = invoice['Fecha']
-                    total = invoice['Total']
-                    inv_num = str(invoice['Num'])
-                    
-                    is_unpaid = pd.isna(payment_date) or (payment_date > snapshot_date)
-                    
-                    if is_unpaid and pd.notna(invoice_date):
-                        days_overdue = (snapshot_date - invoice_date).days
-                        months_overdue = days_overdue / 30.44
-                        
-                        if days_overdue > 0:
-                            if months_overdue < 3:
-                                deuda_lt_3_sum += total
-                                list_lt_3.append(inv_num)
-                            elif 3 <= months_overdue < 6:
-                                deuda_3_6_sum += total
-                                list_3_6.append(inv_num)
-                            elif 6 <= months_overdue < 12:
-                                deuda_6_12_sum += total
-                                list_6_12.append(inv_num)
-                            elif months_overdue >= 12:
-                                deuda_gt_12_sum += total
-                                list_gt_12.append(inv_num)
-                                
-                            prev_month_date = snapshot_date - pd.DateOffset(months=1)
-                            days_overdue_prev = (prev_month_date - invoice_date).days
-                            months_overdue_prev = days_overdue_prev / 30.44
-                            
-                            if (months_overdue_prev < 3) and (months_overdue >= 3):
-                                crossed_3_months_sum += total
-                                list_crossed.append(inv_num)
-
-                            # Check for payments made AFTER the snapshot date (Post-Inicio)
-                            # is_unpaid is True means payment_date > snapshot_date OR payment_date is NaT
-                            # We only care if payment_date is NOT NaT (actual payment happened)
-                            if pd.notna(payment_date):
-                                paid_debt_post_start_sum += total
-                                list_paid_post_start.append(inv_num)
-                                
-                                # Check if it was an alert item
-                                if (months_overdue_prev < 3) and (months_overdue >= 3):
-                                    paid_alert_post_start_sum += total
-                                    list_paid_alert.append(inv_num)
-
-                if deuda_lt_3_sum > 0:
-                    gold_rows.append({
-                        'Fecha_Reporte': snapshot_date,
-                        'Cliente': client,
-                        'Concepto': 'Deuda 0-3 Meses',
-                        'Monto': deuda_lt_3_sum,
-                        'Es_Mes_Actual': is_current_month,
-                        'Numero_Facturas': len(list_lt_3),
-                        'Lista_Facturas': ', '.join(list_lt_3)
-                    })
-                if deuda_3_6_sum > 0:
-                    gold_rows.append({
-                        'Fecha_Reporte': snapshot_date,
-                        'Cliente': client,
-                        'Concepto': 'Deuda 3-6 Meses',
-                        'Monto': deuda_3_6_sum,
-                        'Es_Mes_Actual': is_current_month,
-                        'Numero_Facturas': len(list_3_6),
-                        'Lista_Facturas': ', '.join(list_3_6)
-                    })
-                if deuda_6_12_sum > 0:
-                    gold_rows.append({
-                        'Fecha_Reporte': snapshot_date,
-                        'Cliente': client,
-                        'Concepto': 'Deuda 6-12 Meses',
-                        'Monto': deuda_6_12_sum,
-                        'Es_Mes_Actual': is_current_month,
-                        'Numero_Facturas': len(list_6_12),
-                        'Lista_Facturas': ', '.join(list_6_12)
-                    })
-                if deuda_gt_12_sum > 0:
-                    gold_rows.append({
-                        'Fecha_Reporte': snapshot_date,
-                        'Cliente': client,
-                        'Concepto': 'Deuda > 12 Meses',
-                        'Monto': deuda_gt_12_sum,
-                        'Es_Mes_Actual': is_current_month,
-                        'Numero_Facturas': len(list_gt_12),
-                        'Lista_Facturas': ', '.join(list_gt_12)
-                    })
-                if crossed_3_months_sum > 0:
-                    gold_rows.append({
-                        'Fecha_Reporte': snapshot_date,
-                        'Cliente': client,
-                        'Concepto': 'Alerta: Pasó 3 Meses',
-                        'Monto': crossed_3_months_sum,
-                        'Es_Mes_Actual': is_current_month,
-                        'Numero_Facturas': len(list_crossed),
-                        'Lista_Facturas': ', '.join(list_crossed)
-                    })
-                
-                if is_current_month and paid_debt_post_start_sum > 0:
-                    gold_rows.append({
-                        'Fecha_Reporte': snapshot_date,
-                        'Cliente': client,
-                        'Concepto': 'Pagos Deuda Post-Inicio',
-                        'Monto': paid_debt_post_start_sum,
-                        'Es_Mes_Actual': is_current_month,
-                        'Numero_Facturas': len(list_paid_post_start),
-                        'Lista_Facturas': ', '.join(list_paid_post_start)
-                    })
-                    
-                if is_current_month and paid_alert_post_start_sum > 0:
-                    gold_rows.append({
-                        'Fecha_Reporte': snapshot_date,
-                        'Cliente': client,
-                        'Concepto': 'Pagos Alerta Post-Inicio',
-                        'Monto': paid_alert_post_start_sum,
-                        'Es_Mes_Actual': is_current_month,
-                        'Numero_Facturas': len(list_paid_alert),
-                        'Lista_Facturas': ', '.join(list_paid_alert)
-                    })
-
-        df_gold = pd.DataFrame(gold_rows)
+
+        # Decompose Fecha into its month period once
+        df_consolidado['Fecha_M'] = df_consolidado['Fecha'].dt.to_period('M')
+
+        # Billing: one groupby over (month, cliente) replaces the snapshot loop
+        # and its Python dict/list building entirely
+        df_billing = aggregate_invoices(df_consolidado[df_consolidado['Fecha_M'].notna()], ['Fecha_M', 'Cliente'])
+        df_billing['Fecha_Reporte'] = df_billing['Fecha_M'].dt.to_timestamp()
+        df_billing = df_billing.drop(columns=['Fecha_M'])
+        df_billing['Concepto'] = 'Facturación Mensual'
+
+        # Debt: evaluate every invoice against every snapshot date in one vectorized pass.
+        # date_range is sorted, so a binary search gives each invoice its first overdue
+        # snapshot and only those (invoice, snapshot) pairs are materialized, instead of
+        # a full cross join that immediately discards the half with days_overdue <= 0
+        invoices = df_consolidado[['Fecha', 'Cliente', 'Total', 'Num', 'Fecha de cobro']].dropna(subset=['Fecha'])
+        invoices = invoices.reset_index(drop=True)
+        n_snapshots = len(date_range)
+        first_snap = np.searchsorted(date_range.values, invoices['Fecha'].values, side='right')
+        counts = n_snapshots - first_snap
+        snap_idx = np.repeat(first_snap, counts) + (np.arange(counts.sum()) - np.repeat(counts.cumsum() - counts, counts))
+
+        pairs = invoices.loc[invoices.index.repeat(counts)].reset_index(drop=True)
+        pairs['Fecha_Reporte'] = date_range.values[snap_idx]
+
+        is_unpaid = pairs['Fecha de cobro'].isna() | (pairs['Fecha de cobro'] > pairs['Fecha_Reporte'])
+        pairs = pairs[is_unpaid].copy()
+
+        months_overdue = (pairs['Fecha_Reporte'] - pairs['Fecha']).dt.days / 30.44
+        # The previous snapshot date only depends on the snapshot, so compute it
+        # once per snapshot and map it onto the pairs instead of applying a
+        # DateOffset to every pair row
+        prev_snapshots = pd.Series(date_range - pd.DateOffset(months=1), index=date_range)
+        prev_month_dates = pairs['Fecha_Reporte'].map(prev_snapshots)
+        months_overdue_prev = (prev_month_dates - pairs['Fecha']).dt.days / 30.44
+
+        pairs['Concepto'] = pd.cut(
+            months_overdue,
+            bins=[0, 3, 6, 12, np.inf],
+            labels=['Deuda 0-3 Meses', 'Deuda 3-6 Meses', 'Deuda 6-12 Meses', 'Deuda > 12 Meses'],
+            right=False
+        )
+        crossed_3_months = (months_overdue_prev < 3) & (months_overdue >= 3)
+        # Payments made AFTER the snapshot date (Post-Inicio): the invoice is
+        # unpaid as of the snapshot but an actual payment date exists
+        paid_post_start = pairs['Fecha de cobro'].notna()
+        current_month_start = pd.Timestamp(now.year, now.month, 1)
+        in_current_month = pairs['Fecha_Reporte'] == current_month_start
+
+        debt_frames = [aggregate_invoices(pairs, ['Fecha_Reporte', 'Cliente', 'Concepto'])]
+
+        df_crossed = aggregate_invoices(pairs[crossed_3_months], ['Fecha_Reporte', 'Cliente'])
+        df_crossed['Concepto'] = 'Alerta: Pasó 3 Meses'
+        debt_frames.append(df_crossed)
+
+        df_paid = aggregate_invoices(pairs[paid_post_start & in_current_month], ['Fecha_Reporte', 'Cliente'])
+        df_paid['Concepto'] = 'Pagos Deuda Post-Inicio'
+        debt_frames.append(df_paid)
+
+        df_paid_alert = aggregate_invoices(pairs[paid_post_start & crossed_3_months & in_current_month], ['Fecha_Reporte', 'Cliente'])
+        df_paid_alert['Concepto'] = 'Pagos Alerta Post-Inicio'
+        debt_frames.append(df_paid_alert)
+
+        df_gold = pd.concat([df_billing] + debt_frames, ignore_index=True)
+        df_gold['Es_Mes_Actual'] = (df_gold['Fecha_Reporte'].dt.year == now.year) & (df_gold['Fecha_Reporte'].dt.month == now.month)
+        df_gold = df_gold[['Fecha_Reporte', 'Cliente', 'Concepto', 'Monto', 'Es_Mes_Actual', 'Numero_Facturas', 'Lista_Facturas']]
         
         if not df_gold.empty:
-            # Sort to ensure proper alignment if we were to use shift, though we are using merge
+            # Sort so each (Cliente, Concepto) series is in month order for the shift
             df_gold = df_gold.sort_values(by=['Cliente', 'Concepto', 'Fecha_Reporte'])
-            
-            # Calculate Previous Month Variation
-            # Create a temporary dataframe with previous month's dates shifted forward to match current month
-            df_prev = df_gold[['Fecha_Reporte', 'Cliente', 'Concepto', 'Monto']].copy()
-            df_prev['Fecha_Reporte'] = df_prev['Fecha_Reporte'] + pd.DateOffset(months=1)
-            df_prev = df_prev.rename(columns={'Monto': 'Monto_Anterior'})
-            
-            # Merge to get the previous month's amount on the current row
-            df_gold = pd.merge(
-                df_gold, 
-                df_prev, 
-                on=['Fecha_Reporte', 'Cliente', 'Concepto'], 
-                how='left'
-            )
-            
-            # Fill NaN for Monto_Anterior with 0 (assuming 0 if no previous record)
-            df_gold['Monto_Anterior'] = df_gold['Monto_Anterior'].fillna(0)
-            
-            # Calculate Variation: Current - Previous
-            df_gold['Variacion_Mes_Anterior'] = df_gold['Monto'] - df_gold['Monto_Anterior']
-            
-            # Clean up temporary column
-            df_gold = df_gold.drop(columns=['Monto_Anterior'])
 
-        logging.info(f"Gold Layer generated with {len(df_gold)} rows.")
+            # Previous Month Variation: shift each series one row back and only
+            # keep the value when that row really is the immediately preceding
+            # month (0 otherwise, same as the old merge with fillna(0))
+            grouped = df_gold.groupby(['Cliente', 'Concepto'], observed=True)
+            monto_anterior = grouped['Monto'].shift(1)
+            is_consecutive = grouped['Fecha_Reporte'].shift(1) == df_gold['Fecha_Reporte'] - pd.DateOffset(months=1)
+            monto_anterior = monto_anterior.where(is_consecutive, 0)
+
+            df_gold['Variacion_Mes_Anterior'] = df_gold['Monto'] - monto_anterior
+
+        logging.info("Gold Layer generated with %d rows.", len(df_gold))
 
         # Export to Google Sheets
         output_sheet_name = 'Consolidacion'
@@ -321,10 +237,10 @@ def main():
             try:
                 try:
                     worksheet = sh.worksheet(output_sheet_name)
-                    logging.info(f"Clearing existing sheet '{output_sheet_name}'...")
+                    logging.info("Clearing existing sheet '%s'...", output_sheet_name)
                     worksheet.clear()
                 except gspread.WorksheetNotFound:
-                    logging.info(f"Creating sheet '{output_sheet_name}'...")
+                    logging.info("Creating sheet '%s'...", output_sheet_name)
                     worksheet = sh.add_worksheet(title=output_sheet_name, rows=len(df_gold)+100, cols=len(df_gold.columns))
 
                 df_export = df_gold.copy()
@@ -333,17 +249,22 @@ def main():
                 
                 df_export = df_export.fillna('')
                 data_to_write = [df_export.columns.tolist()] + df_export.values.tolist()
-                worksheet.update(values=data_to_write, range_name='A1')
-                logging.info(f"Successfully exported {len(df_export)} rows to '{output_sheet_name}'.")
+                # RAW skips server-side USER_ENTERED parsing of every cell
+                sh.values_update(
+                    f"'{output_sheet_name}'!A1",
+                    params={'valueInputOption': 'RAW'},
+                    body={'values': data_to_write}
+                )
+                logging.info("Successfully exported %d rows to '%s'.", len(df_export), output_sheet_name)
 
             except Exception as e:
-                logging.error(f"Error exporting to Google Sheets: {e}")
+                logging.error("Error exporting to Google Sheets: %s", e)
                 raise e
         else:
             logging.warning("df_gold is empty. Nothing to export.")
             
     except Exception as e:
-        logging.error(f"Critical error in main process: {e}", exc_info=True)
+        logging.error("Critical error in main process: %s", e, exc_info=True)
         raise e
 
 if __name__ == "__main__":